@@ -1,14 +1,49 @@
 import re
+from pathlib import Path
+
+Pattern = re.Pattern
+Match = re.Match
+
+
+def cov_replacement(match: Match) -> str:
+    """
+    Build the \mathbf{\Sigma} expression for any variant of the \cov family
+    of commands: \cov, \icov, \tcov and \ticov, with a plain, \mat{}-style,
+    \emat{}-style or \text{}-style argument.
+    """
+    result = r'\mathbf{\Sigma}'
+    if match['cov_i']:
+        result += '^{-1}'
+    if match['cov_mat'] is not None:
+        if match['cov_e']:
+            result += r'_{\widehat{\mathbf{%s}}}' % match['cov_mat']
+        else:
+            result += r'_\mathbf{%s}' % match['cov_mat']
+    elif match['cov_text'] is not None:
+        result += r'_\text{%s}' % match['cov_text']
+    else:
+        result += r'_\mathbf{%s}' % match['cov_plain']
+    if match['cov_t']:
+        result = '$' + result + '$'
+    return result
+
+
+# Straight literal replacements, done with str.replace which is much faster
+# than firing up the regex engine for a fixed string.
+literal_patterns = [
+    ('\\begin{figure*}', '\\begin{figure}'),
+    ('\\end{figure*}', '\\end{figure}'),
+    ('\\trans', '^\\mathsf{T}'),
+    ('\\hermconj', '^\\mathsf{H}'),
+    ('\\vspace{2ex}', ''),
+]
 
 # Search-and-replace patterns
 patterns = [
-    (re.compile(r'\\begin{figure\*}'), r'\\begin{figure}'),
-    (re.compile(r'\\end{figure\*}'), r'\\end{figure}'),
-    (re.compile(r'\\tcov{\\mat{([^}]+)}}'), r'$\\mathbf{\\Sigma}_\\mathbf{\1}$'),
-    (re.compile(r'\\tcov{\\emat{([^}]+)}}'), r'$\\mathbf{\\Sigma}_{\\widehat{\\mathbf{\1}}}$'),
-    (re.compile(r'\\tcov{\\text{([^}]+)}}'), r'$\\mathbf{\\Sigma}_\\text{\1}$'),
-    (re.compile(r'\\icov{\\emat{([^}]+)}}'), r'\\mathbf{\\Sigma}^{-1}_{\\widehat{\\mathbf{\1}}}'),
-    (re.compile(r'\\ticov{\\emat{([^}]+)}}'), r'$\\mathbf{\\Sigma}^{-1}_{\\widehat{\\mathbf{\1}}}$'),
+    (re.compile(r'\\(?P<cov_t>t?)(?P<cov_i>i?)cov{'
+                r'(?:\\(?P<cov_e>e?)mat{(?P<cov_mat>[^}]+)}'
+                r'|\\text{(?P<cov_text>[^}]+)}'
+                r'|(?P<cov_plain>[^}]+))}'), cov_replacement),
     (re.compile(r'\\mat{([^}]+)}'), r'\\mathbf{\1}'),
     (re.compile(r'\\vec{([^}]+)}'), r'\\mathbf{\1}'),
     (re.compile(r'\\tmat{([^}]+)}'), r'$\\mathbf{\1}$'),
@@ -17,23 +52,145 @@ patterns = [
     (re.compile(r'\\evec{([^}]+)}'), r'\\widehat{\\mathbf{\1}}'),
     (re.compile(r'\\temat{([^}]+)}'), r'$\\widehat{\\mathbf{\1}}$'),
     (re.compile(r'\\tevec{([^}]+)}'), r'$\\widehat{\\mathbf{\1}}$'),
-    (re.compile(r'\\trans'), r'^\\mathsf{T}'),
-    (re.compile(r'\\hermconj'), r'^\\mathsf{H}'),
-    (re.compile(r'\\cov{([^}]+)}'), r'\\mathbf{\\Sigma}_\\mathbf{\1}'),
-    (re.compile(r'\\icov{([^}]+)}'), r'\\mathbf{\\Sigma}^{-1}_\\mathbf{\1}'),
-    (re.compile(r'\\tcov{([^}]+)}'), r'$\\mathbf{\\Sigma}_\\mathbf{\1}$'),
-    (re.compile(r'\\ticov{([^}]+)}'), r'$\\mathbf{\\Sigma}^{-1}_\\mathbf{\1}$'),
-    (re.compile(r'\\vspace{2ex}'), r''),
 ]
 
-file_in = open('paper/beamformer_framework.tex')
-file_out = open('beamformer_framework_pandoc.tex', 'w')
 
-# Perform search-and-replace line by line
-for line in file_in:
-    for pat, rep in patterns:
-        line = pat.sub(rep, line)
-    file_out.write(line.strip() + '\n')
+def merge_patterns(patterns: list) -> tuple:
+    """
+    Merge the individual patterns into a single alternation regex, so each
+    line is scanned only once instead of once per pattern. Every pattern
+    becomes a named group in the merged regex, group references in the
+    replacement templates are shifted accordingly, and a lookup table maps the
+    matched group index back to the right template. Replacements may also be
+    functions, which should only access groups by name.
+    """
+    sources = []
+    replacements = {}
+    group_index = 1
+    for i, (pat, rep) in enumerate(patterns):
+        sources.append(f'(?P<p{i}>{pat.pattern})')
+        if callable(rep):
+            shifted = rep
+        else:
+            shifted = re.sub(r'\\(\d+)',
+                             lambda m, base=group_index: f'\\g<{base + int(m.group(1))}>',
+                             rep)
+        # The merged match reports the innermost matched group as lastindex,
+        # so map both the outer named group and any inner groups to the
+        # template.
+        for n in range(group_index, group_index + pat.groups + 1):
+            replacements[n] = shifted
+        group_index += pat.groups + 1
+    return re.compile('|'.join(sources)), replacements
+
+
+merged_pattern, replacements = merge_patterns(patterns)
+
+# Literal substrings that every possible match contains. Testing these with
+# the fast C-level substring search before running the merged regex lets us
+# skip the expensive scan when nothing can match, which also cuts the final
+# fixpoint iteration short.
+quick_tokens = (
+    'cov{',  # covers \cov, \icov, \tcov and \ticov
+    '\\mat{',
+    '\\vec{',
+    '\\tmat{',
+    '\\tvec{',
+    '\\emat{',
+    '\\evec{',
+    '\\temat{',
+    '\\tevec{',
+)
+
+
+def replace(match: Match) -> str:
+    """Expand the replacement belonging to the matched pattern."""
+    rep = replacements[match.lastindex]
+    if callable(rep):
+        return rep(match)
+    return match.expand(rep)
+
+
+# The \author[]{} and \affil[]{} commands of the template are unknown to
+# Pandoc, so we collect them ourselves and inject an author block after
+# \maketitle. One pattern handles both commands, so the raw text is scanned
+# only once for each of the collection and removal steps.
+author_affil_pattern = re.compile(
+    r'\\(?P<cmd>author|affil)\[(?P<mark>[^\]]*)\]\{(?P<content>[^}]*)\}')
+
+
+def build_author_block(authors: list, affiliations: list) -> str:
+    """
+    Build a LaTeX author block out of the (marks, name) and (mark, text)
+    tuples collected from the \author and \affil commands.
+    """
+    names = ', '.join(f'{name}\\textsuperscript{{{marks}}}'
+                      for marks, name in authors)
+    affils = '\n\n'.join(f'\\textsuperscript{{{mark}}}{text}'
+                         for mark, text in affiliations)
+    return f'\\maketitle\n\n{names}\n\n{affils}'
+
+
+def inject_author_block(text: str) -> str:
+    """
+    Gather all authors and affiliations up front, strip the commands, and
+    place the author block right after \maketitle.
+    """
+    authors = []
+    affiliations = []
+    for match in author_affil_pattern.finditer(text):
+        if match['cmd'] == 'author':
+            authors.append((match['mark'], match['content']))
+        else:
+            affiliations.append((match['mark'], match['content']))
+    text = author_affil_pattern.sub('', text)
+    return re.sub(r'\\maketitle',
+                  lambda m: build_author_block(authors, affiliations),
+                  text, count=1)
+
+
+def apply_patterns(text: str) -> str:
+    """
+    Perform the search-and-replace in a single pass over the whole file.
+    """
+    # The literal replacements first: these cannot interact with the regex
+    # patterns below.
+    for old, new in literal_patterns:
+        text = text.replace(old, new)
+
+    # Nested commands (e.g. \tcov{\evec{x}}) need another pass over the
+    # replaced text, so repeat the substitution as long as a possible match
+    # remains (the equality check guards against tokens that survive without
+    # matching).
+    while any(token in text for token in quick_tokens):
+        new_text = merged_pattern.sub(replace, text)
+        if new_text == text:
+            break
+        text = new_text
+    return text
+
+
+def strip_lines(text: str) -> str:
+    """
+    Strip leading/trailing whitespace from every line, like the old
+    line-by-line version did.
+    """
+    return re.sub(r'^[ \t]+|[ \t]+$', '', text, flags=re.MULTILINE)
+
+
+def convert(text: str) -> str:
+    """Run the full preprocessing pipeline on the document text."""
+    return strip_lines(apply_patterns(inject_author_block(text)))
+
+
+def main() -> None:
+    text = Path('paper/beamformer_framework.tex').read_text()
+    # Write through a large buffer so the document goes to the OS in one
+    # flush.
+    with open('beamformer_framework_pandoc.tex', 'w',
+              buffering=1 << 20) as file_out:
+        file_out.write(convert(text))
+
 
-file_in.close()
-file_out.close()
+if __name__ == '__main__':
+    main()
@@ -6,31 +6,52 @@ LaTeX class.
 
 Author: Marijn van Vliet <w.m.vanvliet@gmail.com>
 """
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 import os
 from panflute import *
 import re
 import subprocess
 import sys
 
-acronyms = {}
-refcounts = {}
-figures = {}
-tables = {}
+
+@dataclass
+class FilterState:
+    """State shared between the filters, carried around on the doc."""
+    acronyms: dict = field(default_factory=dict)
+    refcounts: dict = field(default_factory=dict)
+    figures: dict = field(default_factory=dict)
+    tables: dict = field(default_factory=dict)
+
+
+# Cache for first_str, keyed on id(). This is safe because the AST stays
+# alive for the duration of the run.
+_first_str_cache = {}
 
 
 def first_str(elem):
     """
     Helper function that returns the first Str() node under the given element.
+    Uses an explicit stack instead of recursion, which saves a Python
+    function call per visited node. Results are cached, so asking for the
+    same element twice does not re-walk its subtree.
     """
+    key = id(elem)
+    if key in _first_str_cache:
+        return _first_str_cache[key]
+    result = None
     if hasattr(elem, 'content'):
-        for child in elem.content:
-            if isinstance(child, Str):
-                return(child)
-            else:
-                t = first_str(child)
-                if t is not None:
-                    return t
-    return None
+        stack = list(reversed(elem.content))
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Str):
+                result = node
+                break
+            if hasattr(node, 'content'):
+                stack.extend(reversed(node.content))
+    _first_str_cache[key] = result
+    return result
 
 
 def load_acronyms():
@@ -43,10 +64,43 @@ def load_acronyms():
     d = os.path.dirname(__file__)
     filename = os.path.join(d, 'paper/acronyms.tex')
     with open(filename, 'r', encoding='utf-8') as acronymsFile:
-        for line in acronymsFile:
-            match = pattern.match(line)
-            if match:
-                acronyms[match.group('label')] = match.group('value')
+        text = acronymsFile.read()
+    return {label: value for _, label, value in pattern.findall(text)}
+
+
+@lru_cache(maxsize=None)
+def _resolve_value(label, value, form, seen):
+    """
+    Work out the replacement text for an acronym. Since the same
+    (label, form) pair tends to occur many times in a paper, the results are
+    cached.
+    """
+    # the given value covers the case: "singular" in form and "long" in form
+
+    # Check the form flags once instead of scanning the string in every
+    # branch below.
+    is_short = "short" in form
+    is_singular = "singular" in form
+
+    if seen and is_short:
+        if is_singular:
+            value = label
+        else:
+            value = label + "s"
+
+    elif "full" in form or is_short:
+        if is_singular:
+            value = value + " (" + label + ")"
+        else:
+            value = value + "s (" + label + "s)"
+
+    elif "abbrv" in form:
+        if is_singular:
+            value = label
+        else:
+            value = label + "s"
+
+    return value
 
 
 def resolve_acronyms(elem, doc):
@@ -55,35 +109,20 @@ def resolve_acronyms(elem, doc):
     expended upon first use.
     """
     if isinstance(elem, Span) and "acronym-label" in elem.attributes:
-        label = elem.attributes["acronym-label"]
-        
-        if label in acronyms:
-            # this is the case: "singular" in form and "long" in form:
-            value = acronyms[label]
-            
-            form = elem.attributes["acronym-form"]
-            if label in refcounts and "short" in form:
-                if "singular" in form:
-                    value = label
-                else:
-                    value = label + "s"
-            
-            elif "full" in form or "short" in form:
-                # remember that label has been used
-                if "short" in form:
-                    refcounts[label] = True
-                
-                if "singular" in form:
-                    value = value + " (" + label + ")"
-                else:
-                    value = value + "s (" + label + "s)"
-            
-            elif "abbrv" in form:
-                if "singular" in form:
-                    value = label
-                else:
-                    value = label + "s"
-            
+        attributes = elem.attributes
+        label = attributes["acronym-label"]
+        state = doc.state
+
+        if label in state.acronyms:
+            form = attributes["acronym-form"]
+            seen = label in state.refcounts
+            value = _resolve_value(label, state.acronyms[label], form, seen)
+
+            # remember that label has been used; mutating refcounts happens
+            # out here so the cached helper stays side-effect free
+            if not seen and "short" in form:
+                state.refcounts[label] = True
+
             return Span(Str(value))
 
 
@@ -105,12 +144,14 @@ def number_float(elem, doc):
     the top of this file) so we can later resolve \autoref{} calls properly.
     """
     if isinstance(elem, Image):
+        figures = doc.state.figures
         fignum = f'Figure {len(figures) + 1}'
         figures[elem.identifier] = fignum
         t = first_str(elem)
         t.text = fignum + ': ' + t.text
         return elem
     elif isinstance(elem, Table):
+        tables = doc.state.tables
         tabnum = f'Table {len(tables) + 1}'
         tables[elem.parent.identifier] = tabnum
         t = first_str(elem.caption)
@@ -119,19 +160,42 @@ def number_float(elem, doc):
 
 
 autoref_pattern = re.compile(r"\\autoref\{(...):(.*)\}")
+
+# Placeholder Str nodes for \autoref{} calls, filled in by fill_in_autorefs()
+# once every float has been numbered.
+pending_autorefs = []
+
+
 def resolve_autoref(elem, doc):
     """
-    Do \autoref{} manually.
+    Do \autoref{} manually. Since the floats are numbered during the same
+    walk, a reference to a float later in the document cannot be resolved
+    right away; a placeholder Str is returned instead and fill_in_autorefs()
+    patches its text once the walk is done.
     """
-    if isinstance(elem, RawInline):
+    if isinstance(elem, RawInline) and elem.text.startswith('\\autoref{'):
         matches = autoref_pattern.match(elem.text)
         if matches:
             float_type = matches.group(1)
             identifier = float_type + ':' + matches.group(2)
-            if float_type == 'fig' and identifier in figures:
-                return Str(figures[identifier])
-            elif float_type == 'tab' and identifier in tables:
-                return Str(tables[identifier])
+            placeholder = Str(elem.text)
+            pending_autorefs.append((placeholder, float_type, identifier))
+            return placeholder
+
+
+def fill_in_autorefs(doc):
+    """
+    Give every \autoref{} placeholder its final text, now that all figures
+    and tables have been numbered. Unknown identifiers keep the literal
+    \autoref{} text.
+    """
+    state = doc.state
+    for placeholder, float_type, identifier in pending_autorefs:
+        if float_type == 'fig':
+            placeholder.text = state.figures.get(identifier, placeholder.text)
+        elif float_type == 'tab':
+            placeholder.text = state.tables.get(identifier, placeholder.text)
+    pending_autorefs.clear()
 
 def add_references_section_heading(elem, doc):
     """
@@ -140,21 +204,47 @@ def add_references_section_heading(elem, doc):
     if isinstance(elem, Div) and elem.identifier == 'refs':
         return [Header(Str('References'), identifier='references'), elem]
 
+# pdftoppm invocations scheduled by rasterize_pdf_images, run in parallel
+# once the walk is done. The set remembers which PNGs are already scheduled,
+# so an image included more than once is only converted once.
+pending_rasterizations = []
+scheduled_pngs = set()
+
+
+@lru_cache(maxsize=None)
+def existing_files(directory):
+    """
+    The set of filenames present in the given directory. Cached, so checking
+    whether an image has already been rasterized costs one directory scan
+    instead of a stat call per image.
+    """
+    try:
+        return frozenset(entry.name for entry in os.scandir(directory))
+    except FileNotFoundError:
+        return frozenset()
+
+
 def rasterize_pdf_images(elem, doc):
     """
-    Rasterize PDF images to PNG with a reasonable resolution.
+    Rasterize PDF images to PNG with a reasonable resolution. The actual
+    pdftoppm calls are scheduled here and executed in parallel by
+    run_rasterizations() after the walk.
     """
     if isinstance(elem, Image):
         print('Rasterizing', elem.url, file=sys.stderr)
-        if elem.url.endswith('.pdf'):
-            url_png = 'paper/' + elem.url.replace('.pdf', '.png')
-            if not os.path.exists(url_png):
-                subprocess.run(['pdftoppm',
-                                '-scale-to', '1024',
-                                '-png',
-                                '-singlefile',
-                                f'paper/{elem.url}',
-                                f'paper/{elem.url[:-4]}'])
+        root, ext = os.path.splitext(elem.url)
+        if ext == '.pdf':
+            url_png = f'paper/{root}.png'
+            directory, filename = os.path.split(url_png)
+            if (url_png not in scheduled_pngs
+                    and filename not in existing_files(directory)):
+                scheduled_pngs.add(url_png)
+                pending_rasterizations.append(['pdftoppm',
+                                               '-scale-to', '1024',
+                                               '-png',
+                                               '-singlefile',
+                                               f'paper/{elem.url}',
+                                               f'paper/{root}'])
             elem.url = url_png
         # Remove any width annotations made in the LaTeX file, which Word
         # cannot handle, so the width defaults to the pagewidth.
@@ -163,30 +253,92 @@ def rasterize_pdf_images(elem, doc):
 
     return elem
 
+
+def run_rasterizations(doc):
+    """
+    Run all scheduled pdftoppm conversions in parallel. The conversions are
+    independent, so there is no point in waiting for one to finish before
+    starting the next. Runs as the finalize step, before the document is
+    handed back to Pandoc.
+    """
+    if pending_rasterizations:
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(subprocess.run, pending_rasterizations))
+        pending_rasterizations.clear()
+        scheduled_pngs.clear()
+
 si_range_pattern = re.compile(r'(.+)\u00a0(.+)\u2013(.+)')
 def fix_si_range(elem, doc):
     """
     By default, pandoc translates \SIRange{1}{2}{\milli\second} to 1 ms--2 ms,
     which I don't like. I prefer 1--2 ms.
     """
-    if isinstance(elem, Str):
+    # Any match must contain an en-dash, which hardly any Str does, so check
+    # that with a fast substring scan before running the regex.
+    if isinstance(elem, Str) and '\u2013' in elem.text:
         matches = si_range_pattern.match(elem.text)
         if matches:
             elem.text = f'{matches.group(1)}\u2013{matches.group(3)}'
     return elem
 
 
+# The element types the filters act on. Everything else (paragraphs, emph,
+# spaces, ...) is skipped with a single isinstance check.
+handled_types = (Span, Cite, Image, Table, RawInline, Str, Div)
+
+
+def apply_filters(elem, doc):
+    """
+    Dispatch to the filter that handles this element type, so all fixups
+    happen in a single walk over the AST instead of one walk per filter.
+    """
+    if not isinstance(elem, handled_types):
+        return None
+    if isinstance(elem, Span):
+        return resolve_acronyms(elem, doc)
+    elif isinstance(elem, Cite):
+        return add_space_to_citation(elem, doc)
+    elif isinstance(elem, Image):
+        number_float(elem, doc)
+        return rasterize_pdf_images(elem, doc)
+    elif isinstance(elem, Table):
+        return number_float(elem, doc)
+    elif isinstance(elem, RawInline):
+        return resolve_autoref(elem, doc)
+    elif isinstance(elem, Str):
+        return fix_si_range(elem, doc)
+    elif isinstance(elem, Div):
+        return add_references_section_heading(elem, doc)
+
+
+def prepare(doc):
+    """
+    Attach the shared filter state to the doc before the walk starts.
+    """
+    doc.state = FilterState(acronyms=load_acronyms())
+
+
+def finalize(doc):
+    """
+    Patch up the \autoref{} placeholders and run the scheduled pdftoppm
+    conversions, after the walk and before the document goes back to Pandoc.
+    """
+    fill_in_autorefs(doc)
+    run_rasterizations(doc)
+
+
 def main(doc=None):
-    load_acronyms()
-    return run_filters([
-        resolve_acronyms,
-        add_space_to_citation,
-        number_float,
-        resolve_autoref,
-        rasterize_pdf_images,
-        fix_si_range,
-        add_references_section_heading,
-    ], doc=doc)
+    standalone = doc is None
+    if standalone:
+        doc = load()
+    prepare(doc)
+    # A single walk handles everything; \autoref{} resolution is deferred to
+    # finalize() since it may refer to floats later in the document.
+    doc = doc.walk(apply_filters, doc=doc)
+    finalize(doc)
+    if standalone:
+        dump(doc)
+    return doc
 
 
 if __name__ == "__main__":